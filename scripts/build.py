@@ -1,10 +1,17 @@
-import os, re, json, time, hashlib, html, traceback
+import os, re, sys, json, time, zlib, hashlib, html, traceback
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import urlsplit
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import ahocorasick
+import fastfeedparser
 import feedparser
+import orjson
 import requests
-from bs4 import BeautifulSoup
 from dateutil import parser as dateparser
+from lxml import etree
+from lxml import html as lxml_html
 
 ROOT = Path(__file__).resolve().parents[1]
 SRC_DIR = ROOT / "sources"
@@ -17,14 +24,32 @@ PUB_DIR = ROOT / "public"
 TIMEOUT = 20
 USER_AGENT = "InfoHubBot/1.0 (+https://github.com)"
 DEFAULT_TTL_DAYS = 30
+DEFAULT_TTL = timedelta(days=DEFAULT_TTL_DAYS)
 FAIL_DISABLE_AFTER = 3
 DISABLE_DURATION = timedelta(hours=24)
+MAX_WORKERS = 32
+# 已见条目 id 的布隆过滤器：约 10^6 条、误判率约 0.1%
+SEEN_BLOOM_BITS = 14_377_600
+SEEN_BLOOM_HASHES = 10
+NOT_MODIFIED = object()  # fetch_feed 的哨兵：源返回 304 或内容与上次相同，无需解析
 
 
 def now_utc():
     return datetime.utcnow().replace(tzinfo=timezone.utc)
 
 
+def fast_parse_date(s):
+    # 源里的日期几乎都是 ISO 8601（Atom）或 RFC 822（RSS），先用标准库快速解析，都不匹配才交给 dateutil
+    try:
+        return datetime.fromisoformat(s)
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(s)
+    except (TypeError, ValueError):
+        return dateparser.parse(s)
+
+
 def read_lines(p: Path):
     if not p.exists(): return []
     return [x.strip() for x in p.read_text(encoding="utf-8", errors="ignore").splitlines() if
@@ -37,100 +62,238 @@ def load_sources():
     return core, secondary
 
 
+def in_shard(url, shard_idx, shard_count):
+    # 用 crc32 而非 hash()：后者每个进程的随机种子不同，分片结果不稳定
+    return zlib.crc32(url.encode("utf-8")) % shard_count == shard_idx
+
+
+def build_automaton(keywords):
+    # 关键词编译成 Aho-Corasick 自动机，一次线性扫描即可判断是否命中任一关键词
+    if not keywords: return None
+    ac = ahocorasick.Automaton()
+    for k in keywords:
+        ac.add_word(k, k)
+    ac.make_automaton()
+    return ac
+
+
+def contains_any(ac, text):
+    return next(ac.iter(text), None) is not None
+
+
 def load_rules():
+    whitelist = set(read_lines(RULE_DIR / "whitelist.txt"))
+    blacklist = set(read_lines(RULE_DIR / "blacklist.txt"))
+    persistent = set(d.lower() for d in read_lines(RULE_DIR / "persistent_domains.txt"))
     return {
-        "whitelist": set(read_lines(RULE_DIR / "whitelist.txt")),
-        "blacklist": set(read_lines(RULE_DIR / "blacklist.txt")),
-        "persistent_domains": set(read_lines(RULE_DIR / "persistent_domains.txt")),
+        "whitelist": whitelist,
+        "blacklist": blacklist,
+        "whitelist_ac": build_automaton(whitelist),
+        "blacklist_ac": build_automaton(blacklist),
+        "persistent_domains": persistent,
+        "persistent_suffixes": tuple("." + d for d in persistent),
+        # 黑白名单的指纹，规则一变，已见条目过滤器即重置
+        "fingerprint": hashlib.blake2b(
+            "\n".join(sorted(whitelist) + [""] + sorted(blacklist)).encode("utf-8"), digest_size=16
+        ).hexdigest(),
     }
 
 
 def domain_of(url):
-    m = re.match(r"^https?://([^/]+)", url.strip(), flags=re.I)
-    return m.group(1).lower() if m else ""
+    # hostname 已去掉端口与用户信息并转为小写
+    return urlsplit(url).hostname or ""
+
+
+HTML_PARSER = lxml_html.HTMLParser(recover=True)
 
 
 def html_to_text(s):
-    return BeautifulSoup(s or "", "lxml").get_text(" ", strip=True)
+    if not s or not s.strip(): return ""
+    try:
+        # 去掉脚本、样式与注释，各文本节点之间补空格，与原先 BeautifulSoup 的 get_text(" ", strip=True) 一致
+        root = lxml_html.fragment_fromstring(s, create_parent="div", parser=HTML_PARSER)
+        for el in list(root.iter("script", "style", etree.Comment)):
+            # 删除后其 tail 会并入前一个文本节点，先补一个空格作为分隔
+            el.tail = " " + (el.tail or "")
+        etree.strip_elements(root, "script", "style", etree.Comment, with_tail=False)
+        text = " ".join(root.itertext())
+    except (etree.ParserError, ValueError):
+        # 无法解析的片段退化为粗暴去标签
+        text = re.sub(r"<[^>]+>", " ", s)
+    return " ".join(text.split())
+
+
+def entry_id(src_url, e):
+    # 只依赖标题、链接与源域名，无需解析摘要即可算出
+    title = (getattr(e, "title", "") or "").strip()
+    link = (getattr(e, "link", "") or "").strip()
+    sig_src = f"{title}|{link}|{domain_of(src_url)}"
+    return hashlib.blake2b(sig_src.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def load_seen(path: Path, rules):
+    # 文件头是生成时的规则指纹；规则变化后旧的“已见”不再可信，返回空过滤器并标记为已重置
+    fingerprint = bytes.fromhex(rules["fingerprint"])
+    if path.exists():
+        data = path.read_bytes()
+        if len(data) == len(fingerprint) + SEEN_BLOOM_BITS // 8 and data.startswith(fingerprint):
+            return bytearray(data[len(fingerprint):]), False
+    return bytearray(SEEN_BLOOM_BITS // 8), True
+
+
+def save_seen(path: Path, rules, seen):
+    path.write_bytes(bytes.fromhex(rules["fingerprint"]) + seen)
+
+
+def seen_positions(sig):
+    # 双重哈希：由一次 blake2b 的两半派生出全部比特位
+    d = hashlib.blake2b(sig.encode("utf-8"), digest_size=16).digest()
+    h1 = int.from_bytes(d[:8], "little")
+    h2 = int.from_bytes(d[8:], "little") | 1
+    return [(h1 + i * h2) % SEEN_BLOOM_BITS for i in range(SEEN_BLOOM_HASHES)]
+
+
+def is_seen(seen, sig):
+    return all(seen[p >> 3] & (1 << (p & 7)) for p in seen_positions(sig))
+
 
+def mark_seen(seen, sig):
+    for p in seen_positions(sig):
+        seen[p >> 3] |= 1 << (p & 7)
 
-def normalize_entry(src_url, e):
+
+def normalize_header(src_url, e, sig):
+    # 只处理廉价字段；sig 为调用方已用 entry_id 算好的 id，摘要的 HTML 解析留给 attach_summary
     title = (getattr(e, "title", "") or "").strip()
     link = (getattr(e, "link", "") or "").strip()
-    summary_html = getattr(e, "summary", "") or getattr(e, "description", "")
-    summary_text = html.unescape(html_to_text(summary_html))
     pub_raw = getattr(e, "published", "") or getattr(e, "updated", "") or ""
     try:
-        pub_dt = dateparser.parse(pub_raw)
+        pub_dt = fast_parse_date(pub_raw)
         if not pub_dt.tzinfo:
             pub_dt = pub_dt.replace(tzinfo=timezone.utc)
-        pub_iso = pub_dt.astimezone(timezone.utc).isoformat()
+        pub_dt = pub_dt.astimezone(timezone.utc)
     except Exception:
-        pub_iso = now_utc().isoformat()
+        pub_dt = now_utc()
+    pub_iso = pub_dt.isoformat()
 
     sdom = domain_of(src_url)
-    sig_src = f"{title}|{link}|{sdom}"
-    sig = hashlib.sha1(sig_src.encode("utf-8")).hexdigest()
     return {
         "id": sig,
         "title": title,
         "link": link,
-        "summary": summary_text,
+        "summary": "",
         "published": pub_iso,
+        "_published_ts": pub_dt.timestamp(),
         "source": src_url,
         "source_domain": sdom
     }
 
 
+def legacy_id(item):
+    # 旧版的 SHA-1 id，仅在迁移期合并上次数据时用于去重；下个版本移除
+    sig_src = f"{item['title']}|{item['link']}|{item['source_domain']}"
+    return hashlib.sha1(sig_src.encode("utf-8")).hexdigest()
+
+
+def attach_summary(item, e):
+    summary_html = getattr(e, "summary", "") or getattr(e, "description", "")
+    item["summary"] = html.unescape(html_to_text(summary_html))
+
+
+def cheap_pass_filters(title, rules):
+    # 标题命中黑名单时全文必然命中，可在解析摘要前直接淘汰；
+    # 白名单则不行——标题未命中，摘要里仍可能命中
+    bl = rules["blacklist_ac"]
+    return not (bl and contains_any(bl, title))
+
+
 def pass_filters(item, rules):
     text = f"{item['title']} {item['summary']}"
-    wl = rules["whitelist"]
-    bl = rules["blacklist"]
-    if wl and not any(k in text for k in wl):
+    wl = rules["whitelist_ac"]
+    bl = rules["blacklist_ac"]
+    if wl and not contains_any(wl, text):
         return False
-    if bl and any(k in text for k in bl):
+    if bl and contains_any(bl, text):
         return False
     return True
 
 
 def is_persistent(item, rules):
     dom = item["source_domain"]
-    return any(dom == d or dom.endswith("." + d) for d in rules["persistent_domains"])
+    return dom in rules["persistent_domains"] or dom.endswith(rules["persistent_suffixes"])
 
 
-def is_expired(item, rules, now):
+def is_expired(item, rules, now_ts):
     if is_persistent(item, rules): return False
-    ttl = timedelta(days=DEFAULT_TTL_DAYS)
-    try:
-        pub = dateparser.parse(item["published"])
-        if not pub.tzinfo: pub = pub.replace(tzinfo=timezone.utc)
-    except Exception:
-        pub = now
-    return (now - pub) > ttl
+    # normalize_header 已算好发布时间戳；旧数据里没有时再解析一次 ISO 字符串
+    pub_ts = item.get("_published_ts")
+    if pub_ts is None:
+        try:
+            pub = datetime.fromisoformat(item["published"])
+            if not pub.tzinfo: pub = pub.replace(tzinfo=timezone.utc)
+            pub_ts = pub.timestamp()
+        except Exception:
+            pub_ts = now_ts
+    return now_ts - pub_ts > DEFAULT_TTL.total_seconds()
+
+
+def make_session():
+    # 所有抓取线程共用一个 Session 以复用连接；连接池大小与线程数一致
+    session = requests.Session()
+    # Accept-Encoding 沿用 requests 的默认值：始终声明 gzip/deflate，装了 brotli 才会声明 br
+    session.headers["User-Agent"] = USER_AGENT
+    adapter = requests.adapters.HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
-def safe_request(url):
+SESSION = make_session()
+
+
+def safe_request(url, session, rec=None):
+    # 带上上次记录的校验头做条件请求，源未变化时服务端返回 304
+    headers = {}
+    if rec and rec.get("etag"):
+        headers["If-None-Match"] = rec["etag"]
+    if rec and rec.get("last_modified"):
+        headers["If-Modified-Since"] = rec["last_modified"]
     try:
-        resp = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=TIMEOUT, allow_redirects=True)
+        resp = session.get(url, headers=headers, timeout=TIMEOUT, allow_redirects=True)
         resp.raise_for_status()
         return resp
     except requests.exceptions.Timeout:
         # 超时重试一次
-        resp = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=TIMEOUT, allow_redirects=True)
+        resp = session.get(url, headers=headers, timeout=TIMEOUT, allow_redirects=True)
         resp.raise_for_status()
         return resp
 
 
-def fetch_feed(url):
+def fetch_feed(url, session, rec=None):
+    # 返回 (url, entries, err, validators)；源未变化时 entries 为 NOT_MODIFIED
     try:
-        resp = safe_request(url)
-        content = resp.text
-        feed = feedparser.parse(content)
-        if feed.bozo and not feed.entries:
-            return [], f"parse error: {getattr(feed, 'bozo_exception', '')}"
-        return feed.entries, None
+        resp = safe_request(url, session, rec)
+        if resp.status_code == 304:
+            return url, NOT_MODIFIED, None, None
+        content = resp.content
+        validators = {
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "body_hash": hashlib.blake2b(content, digest_size=16).hexdigest(),
+        }
+        # 不支持条件请求的服务端常常每次返回相同内容，按内容哈希判断
+        if rec and rec.get("body_hash") == validators["body_hash"]:
+            return url, NOT_MODIFIED, None, validators
+        try:
+            feed = fastfeedparser.parse(content)
+        except Exception:
+            # fastfeedparser 对不规范的源直接报错，交给容错更好的 feedparser
+            feed = feedparser.parse(content)
+            if feed.bozo and not feed.entries:
+                return url, [], f"parse error: {getattr(feed, 'bozo_exception', '')}", None
+        return url, feed.entries, None, validators
     except Exception as e:
-        return [], f"{type(e).__name__}: {str(e)}"
+        return url, [], f"{type(e).__name__}: {str(e)}", None
 
 
 def should_skip_by_state(state, url, now):
@@ -139,7 +302,7 @@ def should_skip_by_state(state, url, now):
     disabled_until = rec.get("disabled_until")
     if disabled_until:
         try:
-            du = dateparser.parse(disabled_until)
+            du = fast_parse_date(disabled_until)
         except Exception:
             du = now
         if now < du:
@@ -147,16 +310,19 @@ def should_skip_by_state(state, url, now):
     return False, None
 
 
-def update_state_on_result(state, url, ok, error_msg, now):
+def update_state_on_result(state, url, ok, error_msg, now, validators=None):
     rec = state.get(url, {
         "last_success": None, "last_error": None,
-        "consecutive_failures": 0, "disabled_until": None
+        "consecutive_failures": 0, "disabled_until": None,
+        "etag": None, "last_modified": None, "body_hash": None
     })
     if ok:
         rec["last_success"] = now.isoformat()
         rec["last_error"] = None
         rec["consecutive_failures"] = 0
         rec["disabled_until"] = None
+        if validators:
+            rec.update(validators)
     else:
         rec["last_error"] = f"{now.isoformat()} {error_msg}"
         rec["consecutive_failures"] = rec.get("consecutive_failures", 0) + 1
@@ -167,16 +333,50 @@ def update_state_on_result(state, url, ok, error_msg, now):
 
 def write_json(path: Path, obj):
     path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
+    path.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+
+
+def write_ndjson(path: Path, items, mode="ab"):
+    # 先整体序列化，再一次 writelines 写入，避免逐条 write
+    lines = [orjson.dumps(it) + b"\n" for it in items]
+    with path.open(mode) as f:
+        f.writelines(lines)
+
+
+# 与 html.escape(quote=True) 等价的转义表，str.translate 单次遍历完成
+HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
+
+def esc(s):
+    return s.translate(HTML_ESCAPE)
+
+
+def load_latest(log_path: Path, legacy_path: Path = None):
+    # index.ndjson 是只追加的日志，同一 id 以最后一次写入为准；可兼容旧版 index.json
+    if log_path.exists():
+        latest = {}
+        for line in log_path.read_bytes().splitlines():
+            try:
+                it = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            latest[it["id"]] = it
+        return list(latest.values())
+    if legacy_path and legacy_path.exists():
+        try:
+            return orjson.loads(legacy_path.read_bytes())
+        except Exception:
+            return []
+    return []
 
 
 def render_index_html(items):
-    lis = "\n".join(
-        f'<li><a href="{i["link"]}" target="_blank">{html.escape(i["title"])}</a> '
-        f'<small>({html.escape(i["source_domain"])}, {html.escape(i["published"])})</small>'
-        f'<br><em>{html.escape(i.get("summary", "")[:200])}</em></li>'
-        for i in items[:300]
-    )
+    parts = []
+    for i in items[:300]:
+        parts.append(f'<li><a href="{esc(i["link"])}" target="_blank">{esc(i["title"])}</a> '
+                     f'<small>({esc(i["source_domain"])}, {esc(i["published"])})</small>'
+                     f'<br><em>{esc(i.get("summary", "")[:200])}</em></li>')
+    lis = "\n".join(parts)
     return f"""<!doctype html><meta charset="utf-8"><title>InfoHub</title>
 <style>body{{font:14px/1.6 -apple-system,BlinkMacSystemFont,Segoe UI,Roboto,Helvetica,Arial;max-width:860px;margin:24px auto;padding:0 12px}}li{{margin:12px 0}}</style>
 <h1>InfoHub 聚合</h1>
@@ -226,17 +426,62 @@ def render_atom_feed(items, feed_title="InfoHub 聚合", feed_link="./", feed_id
 </feed>"""
 
 
-def main():
+def public_item(it):
+    # 下划线开头的是内部字段（如 _published_ts），不进入对外发布的 feed.json
+    return {k: v for k, v in it.items() if not k.startswith("_")}
+
+
+def make_logger(kind, start):
     LOG_DIR.mkdir(parents=True, exist_ok=True)
-    start = now_utc()
-    log_name = f"build-{start.strftime('%Y%m%dT%H%M%SZ')}.log"
-    log_path = LOG_DIR / log_name
+    log_path = LOG_DIR / f"{kind}-{start.strftime('%Y%m%dT%H%M%SZ')}.log"
 
     def log(msg):
         print(msg)
         with log_path.open("a", encoding="utf-8") as f:
             f.write(msg + "\n")
 
+    return log
+
+
+def write_latest_index(latest_dir: Path, alive):
+    # 给读者用的 latest/index.json：由日志合并出的存活集合生成，不含内部字段；两种运行模式都会产出
+    write_json(latest_dir / "index.json", [public_item(it) for it in alive])
+
+
+def publish(alive, state):
+    PUB_DIR.mkdir(parents=True, exist_ok=True)
+    (PUB_DIR / "index.html").write_text(render_index_html(alive), encoding="utf-8")
+    write_json(PUB_DIR / "feed.json", [public_item(it) for it in alive[:200]])
+    (PUB_DIR / "feed.xml").write_text(render_atom_feed(alive), encoding="utf-8")
+    (PUB_DIR / "status.html").write_text(render_status_html(state), encoding="utf-8")
+
+
+def merge_shards():
+    # 汇总各分片的 state 与 latest，生成最终的 latest/index.json 和发布文件
+    log = make_logger("merge", now_utc())
+    rules = load_rules()
+    state = {}
+    for p in sorted(STATE_DIR.glob("sources-shard*.json")):
+        state.update(orjson.loads(p.read_bytes()))
+
+    latest_dir = DATA_DIR / "latest"
+    now_ts = now_utc().timestamp()
+    uniq = {}
+    for p in sorted(latest_dir.glob("index-shard*.ndjson")):
+        for it in load_latest(p):
+            uniq[it["id"]] = it
+    alive = [it for it in uniq.values() if not is_expired(it, rules, now_ts)]
+    alive.sort(key=lambda x: x.get("published", ""), reverse=True)
+
+    write_latest_index(latest_dir, alive)
+    publish(alive, state)
+    log(f"MERGE {len(state)} sources, {len(alive)} alive items")
+
+
+def main():
+    start = now_utc()
+    log = make_logger("build", start)
+
     rules = load_rules()
     core_sources, secondary_sources = load_sources()
 
@@ -245,83 +490,125 @@ def main():
     run_group = os.environ.get("RUN_GROUP", "core")
     sources = core_sources if run_group == "core" else secondary_sources
 
-    state_path = STATE_DIR / "sources.json"
+    # 分片：多个进程各自处理一部分源，写入互不相交的文件，最后由 merge 汇总发布
+    shard_count = int(os.environ.get("SHARD_COUNT", "1"))
+    shard_idx = int(os.environ.get("SHARD_IDX", "0"))
+    sharded = shard_count > 1
+    suffix = f"-shard{shard_idx}" if sharded else ""
+    if sharded:
+        sources = [u for u in sources if in_shard(u, shard_idx, shard_count)]
+
+    state_path = STATE_DIR / f"sources{suffix}.json"
     STATE_DIR.mkdir(parents=True, exist_ok=True)
     if state_path.exists():
-        state = json.loads(state_path.read_text(encoding="utf-8"))
+        state = orjson.loads(state_path.read_bytes())
     else:
         state = {}
+    seen_path = STATE_DIR / f"seen{suffix}.bloom"
+    seen, seen_reset = load_seen(seen_path, rules)
 
     items = []
     fetched = 0
     skipped = 0
 
+    # 整批抓取共用一个时间点，所有 state 更新都用它
+    batch_now = now_utc()
+    urls = []
     for url in sources:
-        n = now_utc()
-        skip, reason = should_skip_by_state(state, url, n)
+        skip, reason = should_skip_by_state(state, url, batch_now)
         if skip:
             log(f"SKIP [{url}] due to state: {reason}")
             skipped += 1
             continue
-
-        log(f"FETCH [{url}] ...")
-        entries, err = fetch_feed(url)
-        if err:
-            log(f"ERROR [{url}]: {err}")
-            update_state_on_result(state, url, ok=False, error_msg=err, now=n)
-            continue
-
-        update_state_on_result(state, url, ok=True, error_msg=None, now=n)
-        fetched += 1
-
-        for e in entries:
-            it = normalize_entry(url, e)
-            if pass_filters(it, rules):
-                items.append(it)
+        urls.append(url)
+
+    # 网络抓取并发进行；state 的更新与条目处理都留在主线程
+    log(f"FETCH {len(urls)} sources with {MAX_WORKERS} workers ...")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        # 各线程只读取提交前复制的 state 记录。
+        # 过滤器重置时不带校验头和内容哈希，强制完整抓取，让未变化的源也按新规则重新过滤
+        if seen_reset:
+            log("RESET seen filter (rules changed or missing), fetching all sources in full")
+        recs = [{} if seen_reset else dict(state.get(u) or {}) for u in urls]
+        results = ex.map(lambda u, r: fetch_feed(u, SESSION, r), urls, recs)
+        for url, entries, err, validators in results:
+            log(f"FETCH [{url}] done")
+            if err:
+                log(f"ERROR [{url}]: {err}")
+                update_state_on_result(state, url, ok=False, error_msg=err, now=batch_now)
+                continue
+
+            update_state_on_result(state, url, ok=True, error_msg=None, now=batch_now, validators=validators)
+            fetched += 1
+            if entries is NOT_MODIFIED:
+                log(f"UNCHANGED [{url}] not modified")
+                continue
+
+            for e in entries:
+                # 以前处理过的条目直接跳过，不再做摘要解析与过滤
+                sig = entry_id(url, e)
+                if is_seen(seen, sig):
+                    continue
+                mark_seen(seen, sig)
+                it = normalize_header(url, e, sig)
+                if not cheap_pass_filters(it["title"], rules):
+                    continue
+                attach_summary(it, e)
+                if pass_filters(it, rules):
+                    items.append(it)
 
     # 去重
     uniq = {it["id"]: it for it in items}
     items = list(uniq.values())
 
     # 加载上次 latest，合并未过期项
-    latest_idx = DATA_DIR / "latest" / "index.json"
-    prev = []
-    if latest_idx.exists():
-        try:
-            prev = json.loads(latest_idx.read_text(encoding="utf-8"))
-        except Exception:
-            prev = []
+    latest_dir = DATA_DIR / "latest"
+    latest_log = latest_dir / f"index{suffix}.ndjson"
+    legacy_idx = None if sharded else latest_dir / "index.json"
+    prev = load_latest(latest_log, legacy_idx)
     nowt = now_utc()
-    alive = [it for it in items if not is_expired(it, rules, nowt)]
+    now_ts = nowt.timestamp()
+    alive = [it for it in items if not is_expired(it, rules, now_ts)]
 
     prev_map = {i["id"]: i for i in prev}
+    alive_ids = {i["id"] for i in alive}
+    # 迁移期：上次数据里仍用 SHA-1 id 的条目被本次的新 id 取代，需重写日志把旧行清掉
+    legacy_ids = {legacy_id(i) for i in alive}
+    replaced_legacy = not legacy_ids.isdisjoint(prev_map)
+    alive_ids |= legacy_ids
     for pid, pit in prev_map.items():
-        if pid not in {i["id"] for i in alive}:
-            if not is_expired(pit, rules, nowt):
-                alive.append(pit)
+        if pid not in alive_ids and not is_expired(pit, rules, now_ts):
+            alive.append(pit)
+            alive_ids.add(pid)
 
     alive.sort(key=lambda x: x.get("published", ""), reverse=True)
 
-    latest_dir = DATA_DIR / "latest"
     archive_dir = DATA_DIR / "archive" / nowt.strftime("%Y-%m")
     latest_dir.mkdir(parents=True, exist_ok=True)
     archive_dir.mkdir(parents=True, exist_ok=True)
 
-    write_json(latest_idx, alive)
-    with (archive_dir / "snapshot.ndjson").open("a", encoding="utf-8") as f:
-        for it in items:
-            f.write(json.dumps(it, ensure_ascii=False) + "\n")
-
-    PUB_DIR.mkdir(parents=True, exist_ok=True)
-    (PUB_DIR / "index.html").write_text(render_index_html(alive), encoding="utf-8")
-    (PUB_DIR / "feed.json").write_text(json.dumps(alive[:200], ensure_ascii=False, indent=2), encoding="utf-8")
-    (PUB_DIR / "feed.xml").write_text(render_atom_feed(alive), encoding="utf-8")
-    (PUB_DIR / "status.html").write_text(render_status_html(state), encoding="utf-8")
+    # index.ndjson 只追加本次新增的条目；过期条目累积到一半以上、首次迁移或有 SHA-1 旧条目被取代时整体重写
+    if not latest_log.exists() or replaced_legacy or len(prev) > 2 * len(alive):
+        write_ndjson(latest_log, alive, mode="wb")
+    else:
+        new_alive = [it for it in alive if it["id"] not in prev_map]
+        if new_alive:
+            write_ndjson(latest_log, new_alive)
+    if items:
+        write_ndjson(archive_dir / f"snapshot{suffix}.ndjson", items)
+
+    if sharded:
+        log(f"SHARD {shard_idx}/{shard_count} done, publish via `build.py merge`")
+    else:
+        write_latest_index(latest_dir, alive)
+        publish(alive, state)
 
     write_json(state_path, state)
+    save_seen(seen_path, rules, seen)
     summary = {
         "time": start.isoformat(),
         "run_group": run_group,
+        "shard": f"{shard_idx}/{shard_count}",
         "fetched_sources": fetched,
         "skipped_sources": skipped,
         "total_sources": len(sources),
@@ -333,4 +620,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["merge"]:
+        merge_shards()
+    else:
+        main()